@@ -1,15 +1,22 @@
+import os
 import re
-import difflib
+import bisect
+import shutil
+import tempfile
 import html
 from pathlib import Path
 
 import streamlit as st
 import streamlit.components.v1 as components
 
+from line_diff import diff_opcodes, group_opcodes
+
 
 # ---------- Конфигурация путей ----------
 
-BASE_DIR = Path(__file__).resolve().parent
+# absolute(), а не resolve(): симлинки раскрывать не нужно, а realpath
+# на каждом rerun скрипта — лишние системные вызовы.
+BASE_DIR = Path(__file__).absolute().parent
 KB_DIR = BASE_DIR / "БЗ"
 AGENTS_DIR = BASE_DIR / "Сценарные агенты"
 MAIN_DIR = BASE_DIR / "Главный промт"
@@ -25,18 +32,24 @@ def get_main_prompt_path() -> Path:
     2) Иначе используем "Основной промт.txt" в корне.
     """
     if MAIN_DIR.exists() and MAIN_DIR.is_dir():
-        files = sorted(
-            [p for p in MAIN_DIR.iterdir() if p.is_file()],
-            key=lambda p: p.name.lower(),
-        )
-        if not files:
-            raise FileNotFoundError('В папке "Главный промт" нет файлов')
+        # Один проход без списка и сортировки: запоминаем первый по
+        # алфавиту файл вообще и первый по алфавиту .txt/.md
+        first = None
         preferred = None
-        for f in files:
-            if f.suffix.lower() in {".txt", ".md"}:
-                preferred = f
-                break
-        return preferred or files[0]
+        with os.scandir(MAIN_DIR) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                key = entry.name.lower()
+                if first is None or key < first[0]:
+                    first = (key, entry.path)
+                if os.path.splitext(key)[1] in {".txt", ".md"} and (
+                    preferred is None or key < preferred[0]
+                ):
+                    preferred = (key, entry.path)
+        if first is None:
+            raise FileNotFoundError('В папке "Главный промт" нет файлов')
+        return Path((preferred or first)[1])
 
     if MAIN_FALLBACK_FILE.exists():
         return MAIN_FALLBACK_FILE
@@ -46,13 +59,70 @@ def get_main_prompt_path() -> Path:
     )
 
 
+@st.cache_data(max_entries=64, show_spinner=False)
+def _read_text_cached(path_str: str, mtime_ns: int) -> str:
+    return Path(path_str).read_text(encoding="utf-8")
+
+
 def read_text_file(path: Path) -> str:
-    return path.read_text(encoding="utf-8")
+    """
+    Чтение через кэш: пока mtime файла не изменился, повторно
+    с диска он не читается.
+    """
+    return _read_text_cached(str(path), path.stat().st_mtime_ns)
+
+
+def _current_umask() -> int:
+    """
+    Текущий umask процесса. На Linux читаем его из /proc, чтобы не
+    трогать umask, общий для всех потоков (сессий) Streamlit.
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError):
+        pass
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
 
 
 def write_text_file(path: Path, content: str) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(content, encoding="utf-8")
+    """
+    Пишем в уникальный временный файл рядом и атомарно подменяем им
+    исходный: файл на диске никогда не бывает пустым или записанным
+    наполовину, даже если две сессии сохраняют его одновременно.
+    Симлинк не подменяется: пишем в файл, на который он указывает.
+    """
+    target = Path(os.path.realpath(path))
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(
+        dir=target.parent, prefix=target.name + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        if target.exists():
+            shutil.copymode(target, tmp)
+        else:
+            # mkstemp создаёт файл с 0600, а новый файл должен
+            # получить обычные права по umask
+            os.chmod(tmp, 0o666 & ~_current_umask())
+        os.replace(tmp, target)
+    except BaseException:
+        # не оставляем *.tmp в БЗ / агентах — иначе он попадёт в индекс
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    # на ФС с грубым mtime запись может не поменять ключ кэша
+    _read_text_cached.clear()
+
+
+_WS_SUB = re.compile(r"\s+").sub
 
 
 def normalize_title_for_match(title: str) -> str:
@@ -62,9 +132,59 @@ def normalize_title_for_match(title: str) -> str:
     - сжимаем пробелы
     - приводим к lower
     """
-    no_colon = title.replace(":", " ")
-    collapsed = re.sub(r"\s+", " ", no_colon)
-    return collapsed.strip().lower()
+    return _WS_SUB(" ", title.replace(":", " ")).strip().lower()
+
+
+def _dir_mtime_ns(path: Path) -> int:
+    """
+    mtime каталога — ключ для кэша индексов: добавление, удаление или
+    переименование файла меняет его, и индекс пересобирается.
+    """
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _kb_index(dir_mtime_ns: int) -> tuple[list[str], dict[str, str]]:
+    """
+    Индекс файлов БЗ:
+    - отсортированный список нормализованных имён (без расширения)
+    - словарь нормализованное имя -> путь
+    Каталог читается один раз на каждое значение dir_mtime_ns.
+    """
+    index = {}
+    if not KB_DIR.exists():
+        return [], index
+
+    with os.scandir(KB_DIR) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            stem = os.path.splitext(entry.name)[0]
+            index.setdefault(normalize_title_for_match(stem), entry.path)
+
+    return sorted(index), index
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _agents_index(dir_mtime_ns: int) -> dict[str, str]:
+    """
+    Индекс файлов сценарных агентов: имя файла без расширения (lower) -> путь.
+    """
+    index = {}
+    if not AGENTS_DIR.exists():
+        return index
+
+    with os.scandir(AGENTS_DIR) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            stem = os.path.splitext(entry.name)[0]
+            index.setdefault(stem.lower(), entry.path)
+
+    return index
 
 
 def find_kb_file_by_title(raw_title: str) -> Path | None:
@@ -72,19 +192,15 @@ def find_kb_file_by_title(raw_title: str) -> Path | None:
     Ищет файл в папке БЗ по заголовку:
     "Правило 3: ПОДТВЕРЖДЕНИЕ ЗАКАЗА" -> "Правило 3 ПОДТВЕРЖДЕНИЕ ЗАКАЗА"
     Сравнение по началу имени файла (без .txt), без учёта регистра.
+    Имена отсортированы, поэтому первый кандидат с нужным префиксом
+    находится бинарным поиском.
     """
-    if not KB_DIR.exists():
-        return None
-
     target = normalize_title_for_match(raw_title)
+    sorted_names, key_to_path = _kb_index(_dir_mtime_ns(KB_DIR))
 
-    for file in KB_DIR.iterdir():
-        if not file.is_file():
-            continue
-        base = file.stem
-        norm = normalize_title_for_match(base)
-        if norm.startswith(target):
-            return file
+    idx = bisect.bisect_left(sorted_names, target)
+    if idx < len(sorted_names) and sorted_names[idx].startswith(target):
+        return Path(key_to_path[sorted_names[idx]])
 
     return None
 
@@ -94,19 +210,16 @@ def find_agent_file_by_name(agent_name: str) -> Path | None:
     Ищет файл сценарного агента по имени, например "cleaner_finance_handler".
     Сначала точное совпадение имени файла без расширения, потом по подстроке.
     """
-    if not AGENTS_DIR.exists():
-        return None
-
-    candidates = [p for p in AGENTS_DIR.iterdir() if p.is_file()]
+    index = _agents_index(_dir_mtime_ns(AGENTS_DIR))
     lower_target = agent_name.lower()
 
-    for file in candidates:
-        if file.stem.lower() == lower_target:
-            return file
+    exact = index.get(lower_target)
+    if exact is not None:
+        return Path(exact)
 
-    for file in candidates:
-        if lower_target in file.stem.lower():
-            return file
+    for stem, file in index.items():
+        if lower_target in stem:
+            return Path(file)
 
     return None
 
@@ -114,85 +227,181 @@ def find_agent_file_by_name(agent_name: str) -> Path | None:
 # ---------- Парсинг ссылок в тексте ----------
 
 LINK_PATTERN = re.compile(
-    r'(Используй статью из БЗ:\s*"([^"]+)"|вызывай агента с именем\s*"([^"]+)")',
+    r'(?:Используй статью из БЗ:\s*"(?P<kb>[^"]+)"'
+    r'|вызывай агента с именем\s*"(?P<agent>[^"]+)")',
     re.IGNORECASE,
 )
 
 
-def parse_prompt_with_links(text: str):
+def _link_span_html(full_match: str) -> str:
+    return (
+        f'<span style="color:#2563eb; text-decoration:underline;">'
+        f"{html.escape(full_match)}</span>"
+    )
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def parse_prompt_with_links(text: str) -> list[dict]:
     """
     Разбивает текст на сегменты:
     - {'type': 'text', 'text': ...}
-    - {'type': 'kb', 'title': ..., 'full_match': ...}
-    - {'type': 'agent', 'name': ..., 'full_match': ...}
+    - {'type': 'kb', 'title': ..., 'full_match': ..., 'html': ...}
+    - {'type': 'agent', 'name': ..., 'full_match': ..., 'html': ...}
+    'html' — готовый span ссылки, чтобы не экранировать его на каждом rerun.
     """
     segments = []
+    append = segments.append
     last_idx = 0
 
     for match in LINK_PATTERN.finditer(text):
         start, end = match.span()
 
         if start > last_idx:
-            segments.append({"type": "text", "text": text[last_idx:start]})
+            append({"type": "text", "text": text[last_idx:start]})
 
-        full_match = match.group(1)
-        kb_title = match.group(2)
-        agent_name = match.group(3)
+        full_match, kb_title, agent_name = match.group(0, "kb", "agent")
 
         if kb_title:
-            segments.append(
+            append(
                 {
                     "type": "kb",
                     "title": kb_title,
                     "full_match": full_match,
+                    "html": _link_span_html(full_match),
                 }
             )
         elif agent_name:
-            segments.append(
+            append(
                 {
                     "type": "agent",
                     "name": agent_name,
                     "full_match": full_match,
+                    "html": _link_span_html(full_match),
                 }
             )
 
         last_idx = end
 
     if last_idx < len(text):
-        segments.append({"type": "text", "text": text[last_idx:]})
+        append({"type": "text", "text": text[last_idx:]})
 
     return segments
 
 
+@st.cache_data(max_entries=8, show_spinner=False)
+def render_plain_text_html(text: str) -> str:
+    """
+    Текст связанного документа для вкладки "Просмотр": HTML-экранирование
+    и переносы строк через <br>.
+    """
+    return html.escape(text).replace("\n", "<br>")
+
+
 # ---------- Diff "Было / Стало" ----------
 
-def make_diff_html(old: str, new: str) -> str:
+_DIFF_STYLE = """
+<style>
+table.diff {font-family: monospace; font-size: 13px; border-collapse: collapse; width: 100%;}
+table.diff td {white-space: pre-wrap; word-break: break-word;}
+.diff_header {background: #f3f4f6; padding: 4px;}
+td.diff_header {width: 1%; text-align: right; color: #6b7280;}
+.diff_next {background: #e5e7eb;}
+.diff_add {background: #e6ffed;}   /* зелёный — добавлено */
+.diff_chg {background: #fff5b1;}   /* жёлтый — изменено */
+.diff_sub {background: #ffeef0;}   /* красный — удалено */
+td, th {padding: 2px 4px; border: 1px solid #e5e7eb;}
+</style>
+"""
+
+_DIFF_TABLE_HEAD = (
+    '<table class="diff">'
+    "<thead><tr>"
+    '<th class="diff_header" colspan="2">Было</th>'
+    '<th class="diff_header" colspan="2">Стало</th>'
+    "</tr></thead>"
+    "<tbody>"
+)
+
+
+def _diff_cell(lines: list[str], idx: int | None, css_class: str) -> str:
     """
-    HTML-таблица diff (слева "Было", справа "Стало") в стиле git.
+    Пара ячеек одной стороны diff: номер строки и сам текст.
+    idx=None — на этой стороне строки нет.
     """
-    old_lines = old.splitlines()
-    new_lines = new.splitlines()
-    diff = difflib.HtmlDiff(wrapcolumn=90)
-    table = diff.make_table(
-        old_lines,
-        new_lines,
-        fromdesc="Было",
-        todesc="Стало",
-        context=True,
-        numlines=3,
+    if idx is None:
+        return '<td class="diff_header"></td><td></td>'
+    return (
+        f'<td class="diff_header">{idx + 1}</td>'
+        f'<td class="{css_class}">{html.escape(lines[idx])}</td>'
     )
-    style = """
-    <style>
-    table.diff {font-family: monospace; font-size: 13px; border-collapse: collapse; width: 100%;}
-    .diff_header {background: #f3f4f6; padding: 4px;}
-    .diff_next {background: #e5e7eb;}
-    .diff_add {background: #e6ffed;}   /* зелёный — добавлено */
-    .diff_chg {background: #fff5b1;}   /* жёлтый — изменено */
-    .diff_sub {background: #ffeef0;}   /* красный — удалено */
-    td, th {padding: 2px 4px; border: 1px solid #e5e7eb;}
-    </style>
+
+
+def _diff_rows(old_lines: list[str], new_lines: list[str]) -> list[str]:
+    """
+    Строки таблицы diff по изменённым блокам с 3 строками контекста.
+    Сравнение только построчное, без подсветки отдельных символов.
+    """
+    rows = []
+
+    for group in group_opcodes(diff_opcodes(old_lines, new_lines), 3):
+        if rows:
+            rows.append('<tr><td class="diff_next" colspan="4"></td></tr>')
+
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for i, j in zip(range(i1, i2), range(j1, j2)):
+                    rows.append(
+                        "<tr>"
+                        + _diff_cell(old_lines, i, "")
+                        + _diff_cell(new_lines, j, "")
+                        + "</tr>"
+                    )
+            elif tag == "delete":
+                for i in range(i1, i2):
+                    rows.append(
+                        "<tr>"
+                        + _diff_cell(old_lines, i, "diff_sub")
+                        + _diff_cell(new_lines, None, "")
+                        + "</tr>"
+                    )
+            elif tag == "insert":
+                for j in range(j1, j2):
+                    rows.append(
+                        "<tr>"
+                        + _diff_cell(old_lines, None, "")
+                        + _diff_cell(new_lines, j, "diff_add")
+                        + "</tr>"
+                    )
+            else:  # replace
+                for k in range(max(i2 - i1, j2 - j1)):
+                    i = i1 + k if i1 + k < i2 else None
+                    j = j1 + k if j1 + k < j2 else None
+                    rows.append(
+                        "<tr>"
+                        + _diff_cell(old_lines, i, "diff_chg")
+                        + _diff_cell(new_lines, j, "diff_chg")
+                        + "</tr>"
+                    )
+
+    if not rows:
+        rows.append(
+            '<tr><td class="diff_next" colspan="4">'
+            "Построчных различий нет</td></tr>"
+        )
+    return rows
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def make_diff_html(old: str, new: str) -> str:
+    """
+    HTML-таблица diff (слева "Было", справа "Стало") в стиле git.
+    Строится напрямую по опкодам SequenceMatcher, без difflib.HtmlDiff
+    и его посимвольного сравнения изменённых строк.
     """
-    return style + table
+    parts = [_DIFF_STYLE, _DIFF_TABLE_HEAD]
+    parts.extend(_diff_rows(old.splitlines(), new.splitlines()))
+    parts.append("</tbody></table>")
+    return "".join(parts)
 
 
 # ---------- Session state ----------
@@ -201,7 +410,7 @@ def init_state():
     if "main_path" not in st.session_state:
         path = get_main_prompt_path()
         content = read_text_file(path)
-        st.session_state.main_path = str(path)
+        st.session_state.main_path = path
         st.session_state.main_original = content
         st.session_state.main_edited = content
 
@@ -234,13 +443,41 @@ def open_linked_target(kind: str, value: str):
     else:
         return
 
+    # Этот файл уже открыт справа — не перечитываем его и не затираем правки
+    if st.session_state.get("linked_path") == file_path:
+        return
+
     content = read_text_file(file_path)
-    st.session_state.linked_path = str(file_path)
+    st.session_state.linked_path = file_path
     st.session_state.linked_label = label
     st.session_state.linked_original = content
     st.session_state.linked_edited = content
 
 
+def get_main_segments() -> list[dict]:
+    """
+    Сегменты главного документа для вкладки "Просмотр".
+    Хранятся в session_state вместе с текстом, по которому построены:
+    на rerun без изменений текста парсинг не повторяется.
+    """
+    text = st.session_state.main_edited
+    if st.session_state.get("segments_source") != text:
+        st.session_state.segments = parse_prompt_with_links(text)
+        st.session_state.segments_source = text
+    return st.session_state.segments
+
+
+def rerun() -> None:
+    """
+    Перезапуск скрипта: st.rerun в актуальных версиях Streamlit,
+    st.experimental_rerun — в старых, где st.rerun ещё нет.
+    """
+    if hasattr(st, "rerun"):
+        st.rerun()
+    else:
+        st.experimental_rerun()
+
+
 # ---------- UI ----------
 
 st.set_page_config(page_title="Редактор промтов и БЗ", layout="wide")
@@ -254,14 +491,20 @@ left_col, right_col = st.columns([3, 2])
 with left_col:
     st.markdown("### Главный документ")
 
-    main_path = Path(st.session_state.main_path)
-    main_tabs = st.tabs(["Просмотр", "Редактирование"])
+    main_path = st.session_state.main_path
+    # radio вместо st.tabs: вкладки st.tabs выполняются обе на каждом
+    # rerun, а здесь строится только выбранный режим
+    main_mode = st.radio(
+        "Режим главного документа",
+        ["Просмотр", "Редактирование"],
+        horizontal=True,
+        key="main_mode",
+        label_visibility="collapsed",
+    )
 
-    with main_tabs[0]:
+    if main_mode == "Просмотр":
         st.caption(f"Файл: `{main_path.name}` (кликабельные ссылки внутри текста)")
-        segments = parse_prompt_with_links(
-            st.session_state.main_edited  # показываем последнюю версию текста
-        )
+        segments = get_main_segments()  # последняя версия текста
 
         # Рендерим по сегментам: обычный текст и “ссылки”, у которых есть кнопка "Развернуть"
         for idx, seg in enumerate(segments):
@@ -272,11 +515,7 @@ with left_col:
                 col_text, col_btn = st.columns([5, 1])
                 with col_text:
                     # визуально подсвечиваем как гиперссылку
-                    st.markdown(
-                        f'<span style="color:#2563eb; text-decoration:underline;">'
-                        f'{html.escape(seg["full_match"])}</span>',
-                        unsafe_allow_html=True,
-                    )
+                    st.markdown(seg["html"], unsafe_allow_html=True)
                 with col_btn:
                     btn_label = "Развернуть"
                     if st.button(
@@ -289,7 +528,7 @@ with left_col:
                         else:
                             open_linked_target("agent", seg["name"])
 
-    with main_tabs[1]:
+    else:
         st.caption(f"Файл: `{main_path.name}` — редактирование напрямую")
 
         edited = st.text_area(
@@ -301,9 +540,14 @@ with left_col:
         st.session_state.main_edited = edited
 
         if edited != st.session_state.main_original:
-            st.markdown("**Предпросмотр изменений (diff \"Было / Стало\")**")
-            diff_html = make_diff_html(st.session_state.main_original, edited)
-            components.html(diff_html, height=400, scrolling=True)
+            # diff считаем только по запросу: st.expander свои блоки
+            # всё равно выполняет, поэтому нужен явный флажок
+            if st.checkbox(
+                "Показать предпросмотр изменений (diff \"Было / Стало\")",
+                key="main_show_diff",
+            ):
+                diff_html = make_diff_html(st.session_state.main_original, edited)
+                components.html(diff_html, height=400, scrolling=True)
 
             col_save, col_reset = st.columns(2)
             with col_save:
@@ -314,7 +558,7 @@ with left_col:
             with col_reset:
                 if st.button("↩️ Отменить изменения (вернуть как было)"):
                     st.session_state.main_edited = st.session_state.main_original
-                    st.experimental_rerun()
+                    rerun()
         else:
             st.info("Изменений в главном документе нет.")
 
@@ -331,20 +575,26 @@ with right_col:
             "чтобы открыть соответствующий файл для редактирования."
         )
     else:
-        linked_path = Path(st.session_state.linked_path)
+        linked_path = st.session_state.linked_path
         label = st.session_state.get("linked_label", linked_path.name)
 
         st.caption(f"Файл: `{label}`")
 
-        linked_tabs = st.tabs(["Просмотр", "Редактирование"])
+        linked_mode = st.radio(
+            "Режим связанного документа",
+            ["Просмотр", "Редактирование"],
+            horizontal=True,
+            key="linked_mode",
+            label_visibility="collapsed",
+        )
 
-        with linked_tabs[0]:
+        if linked_mode == "Просмотр":
             st.markdown(
-                html.escape(st.session_state.linked_edited).replace("\n", "<br>"),
+                render_plain_text_html(st.session_state.linked_edited),
                 unsafe_allow_html=True,
             )
 
-        with linked_tabs[1]:
+        else:
             linked_edited = st.text_area(
                 "Текст связанного документа",
                 value=st.session_state.linked_edited,
@@ -354,11 +604,14 @@ with right_col:
             st.session_state.linked_edited = linked_edited
 
             if linked_edited != st.session_state.linked_original:
-                st.markdown("**Предпросмотр изменений (diff \"Было / Стало\")**")
-                diff_html2 = make_diff_html(
-                    st.session_state.linked_original, linked_edited
-                )
-                components.html(diff_html2, height=350, scrolling=True)
+                if st.checkbox(
+                    "Показать предпросмотр изменений (diff \"Было / Стало\")",
+                    key="linked_show_diff",
+                ):
+                    diff_html2 = make_diff_html(
+                        st.session_state.linked_original, linked_edited
+                    )
+                    components.html(diff_html2, height=350, scrolling=True)
 
                 col_save2, col_reset2 = st.columns(2)
                 with col_save2:
@@ -371,7 +624,7 @@ with right_col:
                         st.session_state.linked_edited = (
                             st.session_state.linked_original
                         )
-                        st.experimental_rerun()
+                        rerun()
             else:
                 st.info("Изменений в связанном документе нет.")
 
@@ -379,10 +632,4 @@ with right_col:
             st.session_state.linked_path = None
             st.session_state.linked_original = ""
             st.session_state.linked_edited = ""
-            try:
-                st.rerun()
-            except Exception:
-                try:
-                    st.experimental_rerun()
-                except Exception:
-                    pass
\ No newline at end of file
+            rerun()
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""
+Построчный diff для предпросмотра "Было / Стало".
+
+Опкоды в формате difflib.SequenceMatcher.get_opcodes(); SequenceMatcher
+запускается только на действительно изменённых участках текста.
+"""
+import bisect
+import difflib
+from collections import Counter
+
+
+# Минимальная длина изменённой середины (в строках), с которой её
+# сначала режут по якорям, а не сравнивают одним SequenceMatcher
+_ANCHOR_MIN_LINES = 100
+
+
+def _matcher_opcodes(old_lines: list[str], new_lines: list[str]) -> list[tuple]:
+    return difflib.SequenceMatcher(
+        None, old_lines, new_lines, autojunk=False
+    ).get_opcodes()
+
+
+def _patience_anchors(old_lines: list[str], new_lines: list[str]) -> list[tuple]:
+    """
+    Якоря в стиле patience diff: строки, которые встречаются ровно один
+    раз в обеих версиях. Из них берётся самая длинная цепочка, идущая
+    в одном порядке с обеих сторон. Возвращает пары (i, j).
+    """
+    old_counts = Counter(old_lines)
+    new_counts = Counter(new_lines)
+    new_pos = {
+        line: j for j, line in enumerate(new_lines) if new_counts[line] == 1
+    }
+    pairs = [
+        (i, new_pos[line])
+        for i, line in enumerate(old_lines)
+        if old_counts[line] == 1 and line in new_pos
+    ]
+
+    # наибольшая возрастающая подпоследовательность по j
+    tails = []
+    tails_j = []
+    prev = [None] * len(pairs)
+    for k, (_, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tails_j, j)
+        if pos:
+            prev[k] = tails[pos - 1]
+        if pos == len(tails):
+            tails.append(k)
+            tails_j.append(j)
+        else:
+            tails[pos] = k
+            tails_j[pos] = j
+
+    anchors = []
+    k = tails[-1] if tails else None
+    while k is not None:
+        anchors.append(pairs[k])
+        k = prev[k]
+    anchors.reverse()
+    return anchors
+
+
+def _anchored_opcodes(old_lines: list[str], new_lines: list[str]) -> list[tuple]:
+    """
+    Опкоды для изменённой середины документа. Уникальные строки-якоря
+    режут её на короткие куски, и SequenceMatcher (квадратичный по длине)
+    запускается только на кусках между якорями.
+    """
+    codes = []
+    prev_i = prev_j = 0
+    anchors = _patience_anchors(old_lines, new_lines)
+
+    for i, j in anchors + [(len(old_lines), len(new_lines))]:
+        old_gap = old_lines[prev_i:i]
+        new_gap = new_lines[prev_j:j]
+        if old_gap == new_gap:
+            # чаще всего промежуток между якорями — одинаковые строки
+            # (пустые и т. п.), SequenceMatcher для них не нужен
+            if old_gap:
+                codes.append(("equal", prev_i, i, prev_j, j))
+        else:
+            codes.extend(
+                (tag, i1 + prev_i, i2 + prev_i, j1 + prev_j, j2 + prev_j)
+                for tag, i1, i2, j1, j2 in _matcher_opcodes(old_gap, new_gap)
+            )
+        if i < len(old_lines):
+            codes.append(("equal", i, i + 1, j, j + 1))
+        prev_i, prev_j = i + 1, j + 1
+
+    # соседние "equal" (якорь + совпадения рядом с ним) склеиваем в один
+    merged = []
+    for code in codes:
+        if merged and code[0] == "equal" and merged[-1][0] == "equal":
+            _, i1, _, j1, _ = merged[-1]
+            merged[-1] = ("equal", i1, code[2], j1, code[4])
+        else:
+            merged.append(code)
+    return merged
+
+
+def diff_opcodes(old_lines: list[str], new_lines: list[str]) -> list[tuple]:
+    """
+    Опкоды SequenceMatcher для двух списков строк.
+    Общие начало и конец отрезаются простым сравнением строк, и
+    SequenceMatcher работает только с изменённой серединой — при обычной
+    правке это несколько строк вместо всего документа.
+    """
+    lo = 0
+    hi_old, hi_new = len(old_lines), len(new_lines)
+    while lo < hi_old and lo < hi_new and old_lines[lo] == new_lines[lo]:
+        lo += 1
+    while (
+        hi_old > lo
+        and hi_new > lo
+        and old_lines[hi_old - 1] == new_lines[hi_new - 1]
+    ):
+        hi_old -= 1
+        hi_new -= 1
+
+    codes = []
+    if lo:
+        codes.append(("equal", 0, lo, 0, lo))
+
+    # Типичный случай при наборе текста — строки только дописаны или
+    # только удалены: тогда сравнивать середину не нужно
+    if lo == hi_old and lo < hi_new:
+        codes.append(("insert", lo, lo, lo, hi_new))
+    elif lo == hi_new and lo < hi_old:
+        codes.append(("delete", lo, hi_old, lo, lo))
+    elif lo < hi_old:
+        old_mid = old_lines[lo:hi_old]
+        new_mid = new_lines[lo:hi_new]
+        # на короткой середине якоря обходятся дороже одного SequenceMatcher
+        if max(len(old_mid), len(new_mid)) >= _ANCHOR_MIN_LINES:
+            middle = _anchored_opcodes(old_mid, new_mid)
+        else:
+            middle = _matcher_opcodes(old_mid, new_mid)
+        for tag, i1, i2, j1, j2 in middle:
+            codes.append((tag, i1 + lo, i2 + lo, j1 + lo, j2 + lo))
+
+    if hi_old < len(old_lines):
+        codes.append(("equal", hi_old, len(old_lines), hi_new, len(new_lines)))
+    return codes
+
+
+def group_opcodes(codes: list[tuple], n: int) -> list[list[tuple]]:
+    """
+    Группы изменений с n строками контекста — как
+    SequenceMatcher.get_grouped_opcodes, но для готового списка опкодов.
+    """
+    if not codes:
+        return []
+
+    codes = list(codes)
+    tag, i1, i2, j1, j2 = codes[0]
+    if tag == "equal":
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    tag, i1, i2, j1, j2 = codes[-1]
+    if tag == "equal":
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > 2 * n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        groups.append(group)
+    return groups
@@ -0,0 +1,95 @@
+import difflib
+import random
+import unittest
+from unittest import mock
+
+import line_diff
+from line_diff import diff_opcodes, group_opcodes
+
+
+def _random_edit(rng, lines, alphabet):
+    new = list(lines)
+    for _ in range(rng.randint(0, 5)):
+        k = rng.randint(0, len(new))
+        op = rng.random()
+        if op < 0.4:
+            new.insert(k, rng.choice(alphabet + "xyz"))
+        elif new and op < 0.8:
+            del new[min(k, len(new) - 1)]
+        elif new:
+            new[min(k, len(new) - 1)] = rng.choice("xyz")
+    return new
+
+
+class DiffOpcodesTest(unittest.TestCase):
+    def assert_valid_opcodes(self, old, new, codes):
+        i_pos = j_pos = 0
+        prev_tag = None
+        for tag, i1, i2, j1, j2 in codes:
+            self.assertEqual((i1, j1), (i_pos, j_pos))
+            self.assertFalse(tag == "equal" and prev_tag == "equal")
+            if tag == "equal":
+                self.assertEqual(old[i1:i2], new[j1:j2])
+            elif tag == "insert":
+                self.assertEqual(i1, i2)
+            elif tag == "delete":
+                self.assertEqual(j1, j2)
+            i_pos, j_pos, prev_tag = i2, j2, tag
+        self.assertEqual((i_pos, j_pos), (len(old), len(new)))
+
+    def test_random_edits_produce_valid_opcodes(self):
+        rng = random.Random(3)
+        # 0 — всегда через якоря, большое значение — без них
+        for threshold in (0, line_diff._ANCHOR_MIN_LINES, 10**9):
+            with mock.patch.object(line_diff, "_ANCHOR_MIN_LINES", threshold):
+                for _ in range(3000):
+                    alphabet = "abcdefghij"[: rng.randint(2, 10)]
+                    old = [rng.choice(alphabet) for _ in range(rng.randint(0, 25))]
+                    new = _random_edit(rng, old, alphabet)
+                    if rng.random() < 0.2:
+                        old, new = new, old
+                    self.assert_valid_opcodes(old, new, diff_opcodes(old, new))
+
+    def test_identical_lines_have_no_groups(self):
+        lines = ["a", "", "b", ""]
+        self.assertEqual(diff_opcodes(lines, list(lines)), [("equal", 0, 4, 0, 4)])
+        self.assertEqual(group_opcodes(diff_opcodes(lines, list(lines)), 3), [])
+
+    def test_pure_append_and_delete(self):
+        old = ["a", "b"]
+        new = ["a", "b", "c", "d"]
+        self.assertEqual(
+            diff_opcodes(old, new), [("equal", 0, 2, 0, 2), ("insert", 2, 2, 2, 4)]
+        )
+        self.assertEqual(
+            diff_opcodes(new, old), [("equal", 0, 2, 0, 2), ("delete", 2, 4, 2, 2)]
+        )
+
+    def test_anchors_split_large_middle(self):
+        old = [f"line {k}" if k % 3 else "" for k in range(600)]
+        new = list(old)
+        new[10] = "changed"
+        new[590] = "changed too"
+        codes = diff_opcodes(old, new)
+        self.assert_valid_opcodes(old, new, codes)
+        self.assertEqual([c for c in codes if c[0] != "equal"], [
+            ("replace", 10, 11, 10, 11),
+            ("replace", 590, 591, 590, 591),
+        ])
+
+
+class GroupOpcodesTest(unittest.TestCase):
+    def test_matches_difflib_grouping(self):
+        rng = random.Random(7)
+        for _ in range(3000):
+            old = [rng.choice("abcde") for _ in range(rng.randint(0, 30))]
+            new = _random_edit(rng, old, "abcde")
+            codes = diff_opcodes(old, new)
+            matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+            matcher.opcodes = codes
+            expected = [list(g) for g in matcher.get_grouped_opcodes(3)]
+            self.assertEqual(group_opcodes(codes, 3), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()